@@ -1,11 +1,33 @@
+import os
 import sys
+import mmap
+import pickle
+import threading
+import multiprocessing
+import functools
+import itertools
+import collections
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import cv2
 from pycocotools.coco import COCO
 import numpy as np
+import tensorflow as tf
 import skimage.io as io
 
+# 多进程模式下每个子进程持有一份generator, 由_init_worker初始化一次, 避免每次任务都序列化coco
+_worker_generator = None
 
-class CoCoDataGenrator:
+
+def _init_worker(generator):
+    global _worker_generator
+    _worker_generator = generator
+
+
+def _worker_data_generation(image_id):
+    return _worker_generator._data_generation(image_id=image_id)
+
+
+class CoCoDataGenrator(tf.keras.utils.Sequence):
     def __init__(self,
                  coco_annotation_file,
                  img_shape=(640, 640, 3),
@@ -13,183 +35,416 @@ class CoCoDataGenrator:
                  max_instances=100,
                  include_crowd=False,
                  include_mask=False,
-                 include_keypoint=False):
+                 include_keypoint=False,
+                 coco_image_dir=None,
+                 image_cache_size=0,
+                 num_workers=4,
+                 prefetch_depth=2,
+                 use_process_pool=False,
+                 image_pack_file=None):
+        super(CoCoDataGenrator, self).__init__()
+        self.coco_annotation_file = coco_annotation_file
+        self.coco_image_dir = coco_image_dir
+        self.image_cache_size = image_cache_size
+        self.image_pack_file = image_pack_file
         self.img_shape = img_shape
         self.batch_size = batch_size
         self.max_instances = max_instances
         self.include_crowd = include_crowd
         self.include_mask = include_mask
         self.include_keypoint = include_keypoint
+        self.num_workers = num_workers
+        self.prefetch_depth = max(1, prefetch_depth)
+        self.use_process_pool = use_process_pool
 
-        self.current_batch_index = 0
+        self._cursor = 0
         self.total_batch_size = 0
         self.img_ids = []
-        self.coco = COCO(annotation_file=coco_annotation_file)
+        self.coco = self._load_coco(coco_annotation_file)
+        # 每个实例的关键点个数, coco只有person类别有17个关键点, 类别里没声明时以标注里的实际个数为准
+        self.num_keypoints = max([len(c.get('keypoints', [])) for c in self.coco.cats.values()] + [0])
+        # 缓存解码后的原图(每张约1MB, 多进程时每个进程各一份), 每个epoch都会打乱顺序,
+        # 只有缓存能放下整个数据集时才有用, 默认关闭
+        if self.image_cache_size > 0:
+            self._read_image = functools.lru_cache(maxsize=self.image_cache_size)(self._read_image)
+        self._open_image_pack()
         self.load_data()
 
+        # 后台线程池/进程池预取后面几个batch, 解码/resize与训练并行, 第一次取数据时才启动
+        self._pool = None
+        self._prefetch_queue = collections.deque()
+        # keras会在多个线程里并发调用__getitem__, 创建线程池/剔除图片时加锁
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # 线程池/预取队列/图片缓存不能跨进程, coco在子进程里从.pkl缓存重新加载
+        state = self.__dict__.copy()
+        for k in ('_pool', '_prefetch_queue', '_lock', '_read_image', 'coco', '_image_pack', '_image_pack_index'):
+            state.pop(k, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.coco = self._load_coco(self.coco_annotation_file)
+        if self.image_cache_size > 0:
+            self._read_image = functools.lru_cache(maxsize=self.image_cache_size)(self._read_image)
+        self._open_image_pack()
+        self._pool = None
+        self._prefetch_queue = collections.deque()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _load_coco(coco_annotation_file):
+        """ 解析coco标注json很慢, 解析结果缓存到同目录的.pkl, json更新过才重新解析
+        :param coco_annotation_file:
+        :return: COCO
+        """
+        cache_file = coco_annotation_file + '.pkl'
+        if os.path.exists(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(coco_annotation_file):
+            # 缓存损坏或者是别的pycocotools/numpy版本写的, 读不出来就重新解析覆盖
+            try:
+                with open(cache_file, 'rb') as f:
+                    return pickle.load(f)
+            except Exception:
+                pass
+
+        coco = COCO(annotation_file=coco_annotation_file)
+        # 先写临时文件再改名, 避免中途退出留下不完整的缓存, 临时文件按进程区分, 多个进程同时写不会互相覆盖
+        tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+        try:
+            with open(tmp_file, 'wb') as f:
+                pickle.dump(coco, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        return coco
+
+    def _open_image_pack(self):
+        """ mmap打包好的jpeg文件, 读图不再每张图打开/关闭文件, 打包见pack_coco_images
+        """
+        self._image_pack = None
+        self._image_pack_index = {}
+        if not self.image_pack_file:
+            return
+
+        index_file = self.image_pack_file + '.idx'
+        if not (os.path.exists(self.image_pack_file) and os.path.exists(index_file)):
+            raise FileNotFoundError("image pack {} not found, build it first with pack_coco_images()".format(
+                self.image_pack_file))
+
+        with open(index_file, 'rb') as f:
+            pack_info = pickle.load(f)
+        # 打包时的标注文件和当前的不一致, 直接用会只剩下少量图片
+        if pack_info['image_ids'] != set(self.coco.imgs):
+            raise ValueError("image pack {} was built from {}, not {}".format(
+                self.image_pack_file, pack_info['annotation_file'], self.coco_annotation_file))
+
+        self._image_pack_index = pack_info['index']
+        if self._image_pack_index:
+            with open(self.image_pack_file, 'rb') as f:
+                self._image_pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
     def load_data(self):
-        # 初步过滤数据是否包含crowd
-        target_img_ids = []
-        for k in self.coco.imgToAnns:
-            annos = self.coco.imgToAnns[k]
-            print(annos)
-            if annos:
-                annos = list(filter(lambda x: x['iscrowd'] == self.include_crowd, annos))
-                if annos:
-                    target_img_ids.append(k)
+        # 初步过滤数据是否包含crowd, 只扫一遍所有标注
+        valid_img_ids = {a['image_id'] for a in self.coco.anns.values() if a['iscrowd'] == self.include_crowd}
+        target_img_ids = [k for k in self.coco.imgToAnns if k in valid_img_ids]
+        if len(target_img_ids) < self.batch_size:
+            raise ValueError("only {} usable images found in {}, fewer than batch_size {}".format(
+                len(target_img_ids), self.coco_annotation_file, self.batch_size))
         self.total_batch_size = len(target_img_ids) // self.batch_size
         self.img_ids = target_img_ids
 
-    def next_batch(self):
-        if self.current_batch_index >= self.total_batch_size:
-            self.current_batch_index = 0
-            self._on_epoch_end()
-
-        batch_img_ids = self.img_ids[self.current_batch_index * self.batch_size:
-                                     (self.current_batch_index + 1) * self.batch_size]
-        batch_imgs = []
-        batch_bboxes = []
-        batch_labels = []
-        batch_masks = []
-        batch_keypoints = []
-        for img_id in batch_img_ids:
-            # {"img":, "bboxes":, "labels":, "masks":, "key_points":}
-            data = self._data_generation(image_id=img_id)
-            if len(np.shape(data['img'])) > 0:
-                batch_imgs.append(data['img'])
+    def _next_img_id(self):
+        img_id = self.img_ids[self._cursor]
+        self._cursor = (self._cursor + 1) % len(self.img_ids)
+        if self._cursor == 0:
+            self.on_epoch_end()
+        return img_id
 
-                if len(data['labels']) > self.max_instances:
-                    batch_bboxes.append(data['bboxes'][:self.max_instances, :])
-                    batch_labels.append(data['labels'][:self.max_instances])
+    def _drop_img_id(self, img_id):
+        """ 读不出来的图片从img_ids里剔除, 之后的epoch不再重复读取
+        :param img_id:
+        """
+        with self._lock:
+            if img_id not in self.img_ids:
+                return
+            pos = self.img_ids.index(img_id)
+            del self.img_ids[pos]
+            if len(self.img_ids) < self.batch_size:
+                raise RuntimeError("only {} readable images left, fewer than batch_size {}".format(
+                    len(self.img_ids), self.batch_size))
+            # 游标之前的图片被删了, 游标跟着前移, 保证不跳过图片
+            if pos < self._cursor:
+                self._cursor -= 1
+            self._cursor %= len(self.img_ids)
+            self.total_batch_size = len(self.img_ids) // self.batch_size
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                if self.use_process_pool:
+                    # 这时tensorflow/模型已经加载并起了线程, fork多线程进程可能死锁, 用spawn新起子进程
+                    self._pool = ProcessPoolExecutor(max_workers=self.num_workers,
+                                                     mp_context=multiprocessing.get_context('spawn'),
+                                                     initializer=_init_worker, initargs=(self,))
                 else:
-                    pad_num = self.max_instances - len(data['labels'])
-                    batch_bboxes.append(np.pad(data['bboxes'], [(0,pad_num), (0, 0)]))
-                    batch_labels.append(np.pad(data['labels'], [(0,pad_num)]))
+                    self._pool = ThreadPoolExecutor(max_workers=self.num_workers)
+            return self._pool
 
-                if self.include_mask:
-                    batch_masks.append(data['masks'])
+    def close(self):
+        """ 关闭后台线程池/进程池, 丢弃已预取的batch
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            if sys.version_info >= (3, 9):
+                pool.shutdown(wait=True, cancel_futures=True)
+            else:
+                pool.shutdown(wait=True)
+        self._prefetch_queue.clear()
+
+    def _fill_prefetch_queue(self):
+        while len(self._prefetch_queue) < self.prefetch_depth:
+            batch_img_ids = [self._next_img_id() for _ in range(self.batch_size)]
+            self._prefetch_queue.append(self._submit_batch(batch_img_ids))
+
+    def _submit_batch(self, batch_img_ids):
+        """ 把一个batch的图片提交到线程池/进程池处理
+        :param batch_img_ids:
+        :return: 预分配的batch输出, 图片id, 每张图对应的future
+        """
+        # 整个batch的图片预先分配好, 每张图直接resize写入对应位置
+        batch = self._alloc_batch()
+        pool = self._get_pool()
+        if self.use_process_pool:
+            futures = [pool.submit(_worker_data_generation, img_id) for img_id in batch_img_ids]
+        else:
+            futures = [pool.submit(self._data_generation, image_id=img_id, im_out=batch['imgs'][i])
+                       for i, img_id in enumerate(batch_img_ids)]
+        return batch, batch_img_ids, futures
+
+    def _alloc_batch(self):
+        """ 按最终shape/dtype预分配一个batch的输出, mask/keypoint在_collect_batch里分配,
+            mask的实例维度要等整个batch的结果回来后按实际最大实例数分配, keypoint个数按标注实际个数,
+            按max_instances分配的话640x640x100的int8每张图就要约41MB
+        :return: {"imgs":, "bboxes":, "labels":, "masks":, "keypoints":}
+        """
+        b, h, w = self.batch_size, self.img_shape[0], self.img_shape[1]
+        return {
+            'imgs': np.zeros((b, h, w, 3), dtype=np.uint8),
+            'bboxes': np.zeros((b, self.max_instances, 4), dtype=np.int16),
+            'labels': np.zeros((b, self.max_instances), dtype=np.int8),
+            'masks': np.zeros((0,), dtype=np.int8),
+            'keypoints': np.zeros((0,), dtype=np.int16)
+        }
 
-                if self.include_keypoint:
-                    batch_keypoints.append(data['keypoints'])
+    def __len__(self):
+        return self.total_batch_size
 
-        self.current_batch_index += 1
+    def __getitem__(self, idx):
+        """ keras Sequence接口, 按batch下标取数据, 可包装成tf.data.Dataset由框架负责并行预取,
+            返回的是原始数据dict而不是(x, y), yolo目标值需要自己生成; 脚本里顺序训练用next_batch即可
+        :param idx: batch下标
+        :return: {"imgs":, "bboxes":, "labels":, "masks":, "keypoints":}
+        """
+        # 读图失败剔除图片后最后一个batch可能不够, 从头取图补齐
+        batch_img_ids = [self.img_ids[k % len(self.img_ids)]
+                         for k in range(idx * self.batch_size, (idx + 1) * self.batch_size)]
+        output, batch_img_ids, batch_futures = self._submit_batch(batch_img_ids)
+        # 读图失败时按顺序取这个batch后面的图补上, 不能动_cursor, 否则会触发on_epoch_end打乱img_ids
+        start = (idx + 1) * self.batch_size
+        fallback_ids = (self.img_ids[k % len(self.img_ids)] for k in itertools.count(start))
+        return self._collect_batch(output, batch_img_ids, batch_futures, next_img_id=lambda: next(fallback_ids))
 
-        if len(batch_imgs) < self.batch_size:
-            return self.next_batch()
+    def next_batch(self):
+        self._fill_prefetch_queue()
+        output, batch_img_ids, batch_futures = self._prefetch_queue.popleft()
+        self._fill_prefetch_queue()
+        return self._collect_batch(output, batch_img_ids, batch_futures, next_img_id=self._next_img_id)
+
+    def _collect_batch(self, output, batch_img_ids, batch_futures, next_img_id):
+        """ 等待batch里每张图处理完, 写入预分配的输出, 读图失败的图片从img_ids里剔除
+        :param batch_img_ids:
+        :param next_img_id: 读图失败时取下一张补位图片id的函数
+        :return: {"imgs":, "bboxes":, "labels":, "masks": [batch, h, w, 本batch最大实例数], "keypoints":}
+        """
+        batch_data = []
+        for i, (img_id, future) in enumerate(zip(batch_img_ids, batch_futures)):
+            # {"img":, "bboxes":, "labels":, "masks":, "key_points":}
+            data = future.result()
+            if self.use_process_pool and data['img'] is not None:
+                # 子进程没法直接写这里的batch, 把结果拷贝进来
+                output['imgs'][i] = data['img']
+            # 读图失败的位置继续往后取图补上, 保证batch是满的, 整个数据集都读不到则报错
+            retries = 0
+            while data['img'] is None:
+                if retries >= len(self.img_ids):
+                    raise RuntimeError("failed to read {} images in a row, check coco_image_dir or network".format(
+                        retries + 1))
+                retries += 1
+                self._drop_img_id(img_id)
+                img_id = next_img_id()
+                data = self._data_generation(image_id=img_id, im_out=output['imgs'][i])
+            batch_data.append(data)
 
-        output = {
-            'imgs': np.array(batch_imgs, dtype=np.int32),
-            'bboxes': np.array(batch_bboxes, dtype=np.int16),
-            'labels':np.array(batch_labels,dtype=np.int8),
-            'masks':np.array(batch_masks, dtype=np.int8),
-            'keypoints':np.array(batch_keypoints, dtype=np.int16)
-        }
+        if self.include_mask:
+            instance_num = max(min(np.shape(data['masks'])[-1], self.max_instances) for data in batch_data)
+            output['masks'] = np.zeros((self.batch_size, self.img_shape[0], self.img_shape[1], instance_num),
+                                       dtype=np.int8)
+
+        if self.include_keypoint:
+            keypoint_nums = {np.shape(data['keypoints'])[1] for data in batch_data if len(data['keypoints']) > 0}
+            if len(keypoint_nums) > 1:
+                raise ValueError("annotations in one batch have different keypoint counts: {}".format(
+                    sorted(keypoint_nums)))
+            keypoint_num = keypoint_nums.pop() if keypoint_nums else self.num_keypoints
+            output['keypoints'] = np.zeros((self.batch_size, self.max_instances, keypoint_num, 3), dtype=np.int16)
+
+        for i, data in enumerate(batch_data):
+            # 输出已置零, 多余的截断, 不足的部分就是padding
+            n = min(len(data['labels']), self.max_instances)
+            output['bboxes'][i, :n] = data['bboxes'][:n]
+            output['labels'][i, :n] = data['labels'][:n]
+
+            if self.include_mask:
+                masks = data['masks'][..., :self.max_instances]
+                output['masks'][i, ..., :np.shape(masks)[-1]] = masks
+
+            if self.include_keypoint and len(data['keypoints']) > 0:
+                keypoints = data['keypoints'][:self.max_instances]
+                output['keypoints'][i, :len(keypoints)] = keypoints
 
         return output
 
-    def _on_epoch_end(self):
+    @staticmethod
+    def as_model_input(imgs):
+        """ batch图片以uint8存储, 喂给模型前再转float32并归一化, 在默认设备(GPU)上完成
+        :param imgs: [batch, h, w, 3] uint8
+        :return: [batch, h, w, 3] float32, 0~1
+        """
+        return tf.cast(imgs, tf.float32) / 255.
+
+    def on_epoch_end(self):
         np.random.shuffle(self.img_ids)
 
-    def _resize_im(self, origin_im, bboxes):
+    def _resize_im(self, origin_im, bboxes, out=None):
         """ 对图片/mask/box resize
 
         :param origin_im
-        :param bboxes
-        :return im_blob: [h, w, 3]
+        :param bboxes: [N, [xmin, ymin, xmax, ymax]] float32
+        :param out: 预分配好的[h, w, 3]输出, 需已置零, 为None时新建
+        :return im_blob: [h, w, 3] uint8
                 gt_boxes: [N, [ymin, xmin, ymax, xmax]]
         """
-        im_shape = np.shape(origin_im)
-        im_size_max = np.max(im_shape[0:2])
-        im_scale = float(self.img_shape[0]) / float(im_size_max)
+        h, w = origin_im.shape[:2]
+        im_scale = float(self.img_shape[0]) / float(max(h, w))
+        new_h, new_w = self._resized_hw(h, w, im_scale)
 
-        # resize原始图片
-        im_resize = cv2.resize(origin_im, None, None, fx=im_scale, fy=im_scale, interpolation=cv2.INTER_LINEAR)
-        im_resize_shape = np.shape(im_resize)
-        im_blob = np.zeros(self.img_shape, dtype=np.float32)
-        im_blob[0:im_resize_shape[0], 0:im_resize_shape[1], :] = im_resize
+        # resize原始图片, 显式给出目标尺寸, 缩小时INTER_AREA更清晰也更快
+        interpolation = cv2.INTER_AREA if im_scale < 1 else cv2.INTER_LINEAR
+        im_resize = cv2.resize(origin_im, (new_w, new_h), interpolation=interpolation)
+        im_blob = np.zeros(self.img_shape, dtype=np.uint8) if out is None else out
+        im_blob[0:new_h, 0:new_w, :] = im_resize
 
         # resize对应边框
-        bboxes_resize = np.array(bboxes * im_scale, dtype=np.int16)
+        bboxes_resize = np.rint(bboxes * np.float32(im_scale)).astype(np.int16)
 
         return im_blob, bboxes_resize
 
+    def _resized_hw(self, h, w, im_scale):
+        """ 按比例缩放后的整数尺寸, 不超过输出大小
+        :return: new_h, new_w
+        """
+        return min(int(round(h * im_scale)), self.img_shape[0]), min(int(round(w * im_scale)), self.img_shape[1])
+
     def _resize_mask(self, origin_masks):
         """ resize mask数据
         :param origin_mask:
         :return: mask_resize: [h, w, instance]
                  gt_boxes: [N, [ymin, xmin, ymax, xmax]]
         """
-        mask_shape = np.shape(origin_masks)
-        mask_size_max = np.max(mask_shape[0:2])
-        im_scale = float(self.img_shape[0]) / float(mask_size_max)
-
-        # resize mask/box
-        gt_boxes = []
-        masks_resize = []
-        for m in origin_masks:
-            m = np.array(m, dtype=np.float32)
-            m_resize = cv2.resize(m, None, None, fx=im_scale, fy=im_scale, interpolation=cv2.INTER_LINEAR)
-            m_resize = np.array(m_resize >= 0.5, dtype=np.int8)
-
-            # 计算bdbox
-            h, w = np.shape(m_resize)
-            rows, cols = np.where(m_resize)
-            # [xmin, ymin, xmax, ymax]
-            xmin = np.min(cols) if np.min(cols) >= 0 else 0
-            ymin = np.min(rows) if np.min(rows) >= 0 else 0
-            xmax = np.max(cols) if np.max(cols) <= w else w
-            ymax = np.max(rows) if np.max(rows) <= h else h
-            bdbox = [xmin, ymin, xmax, ymax]
-            gt_boxes.append(bdbox)
-
-            mask_blob = np.zeros((self.img_shape[0], self.img_shape[1], 1), dtype=np.float32)
-            mask_blob[0:h, 0:w, 0] = m_resize
-            masks_resize.append(mask_blob)
+        # [N, h, w], 每个实例的mask大小都是原图大小, 取第一个即可, 不用把所有mask堆成一个数组
+        mask_h, mask_w = origin_masks[0].shape[:2]
+        im_scale = float(self.img_shape[0]) / float(max(mask_h, mask_w))
+        h, w = self._resized_hw(mask_h, mask_w, im_scale)
+
+        # resize mask/box, 预分配好输出, 每个实例直接写入对应位置
+        instance_num = len(origin_masks)
+        gt_boxes = np.empty((instance_num, 4), dtype=np.int16)
+        masks_resize = np.zeros((instance_num, self.img_shape[0], self.img_shape[1]), dtype=np.int8)
+        for idx, m in enumerate(origin_masks):
+            # 二值mask直接用uint8最近邻缩放, 不需要转float再阈值化
+            m_resize = cv2.resize(m.astype(np.uint8, copy=False), (w, h), interpolation=cv2.INTER_NEAREST)
+
+            # 计算bdbox, [xmin, ymin, xmax, ymax]
+            x, y, box_w, box_h = cv2.boundingRect(m_resize)
+            gt_boxes[idx] = [x, y, x + box_w, y + box_h]
+            masks_resize[idx, 0:h, 0:w] = m_resize
 
         # [instance_num, [ymin, xmin, ymax, xmax]]
-        gt_boxes = np.array(gt_boxes, dtype=np.int16)
-        # [h, w, instance_num]
-        masks_resize = np.concatenate(masks_resize, axis=-1)
+        np.clip(gt_boxes, 0, [self.img_shape[1], self.img_shape[0]] * 2, out=gt_boxes)
+        # [h, w, instance_num], 只是转置视图不拷贝
+        masks_resize = masks_resize.transpose((1, 2, 0))
 
         return masks_resize, gt_boxes
 
-    def _data_generation(self, image_id):
+    def _read_image(self, image_id):
+        """ 读取原图, 优先从打包的mmap文件解码, 其次本地coco图片目录, 本地没有这张图则从coco_url下载
+        :param image_id:
+        :return: [h, w, 3] RGB
+        """
+        if image_id in self._image_pack_index:
+            offset, length = self._image_pack_index[image_id]
+            # 索引和打包文件对不上时offset可能越界/解码失败, 继续从本地目录/coco_url读
+            if offset + length <= len(self._image_pack):
+                buf = np.frombuffer(self._image_pack, dtype=np.uint8, count=length, offset=offset)
+                img = cv2.imdecode(buf, cv2.IMREAD_COLOR)
+                if img is not None:
+                    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+        path = os.path.join(self.coco_image_dir, self.coco.imgs[image_id]['file_name']) \
+            if self.coco_image_dir else None
+        if path and os.path.isfile(path):
+            img = cv2.imread(path, cv2.IMREAD_COLOR)
+            if img is None:
+                return []
+            return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+        img = io.imread(self.coco.imgs[image_id]['coco_url'])
+        if len(np.shape(img)) < 2:
+            return []
+        elif len(np.shape(img)) == 2:
+            img = cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
+        return img
+
+    def _data_generation(self, image_id, im_out=None):
         """ 拉取coco标记数据, 目标边框, 类别, mask
         :param image_id:
+        :param im_out: 预分配的图片输出位置, 见_resize_im
         :return:
         """
 
         anno_ids = self.coco.getAnnIds(imgIds=image_id, iscrowd=self.include_crowd)
-        bboxes = []
-        labels = []
-        masks = []
-        keypoints = []
-        for i in anno_ids:
-            # 边框, 处理成左上右下坐标
-            ann = self.coco.anns[i]
-            bbox = ann['bbox']
-            xmin, ymin, w, h = bbox
-            xmin = int(xmin)
-            ymin = int(ymin)
-            xmax = int(xmin + w)
-            ymax = int(ymin + h)
-            bboxes.append([xmin, ymin, xmax, ymax])
-            # 类别ID
-            label = ann['category_id']
-            labels.append(label)
-            # 实例分割
-            if self.include_mask:
-                mask = self.coco.annToMask(ann)
-                masks.append(mask)
-            if self.include_keypoint and ann.get('keypoints'):
-                keypoint = ann['keypoints']
-                # 处理成[x,y,v] 其中v=0表示没有此点,v=1表示被挡不可见,v=2表示可见
-                keypoint = np.reshape(keypoint, [-1, 3])
-                keypoints.append(keypoint)
-
-        # 输出包含5个东西, 不需要则为空
+        anns = [self.coco.anns[i] for i in anno_ids]
+        # 边框, 处理成左上右下坐标, 保持float32, resize时再一次性取整成int16
+        bboxes = np.array([a['bbox'] for a in anns], dtype=np.float32).reshape(-1, 4)
+        bboxes[:, 2] += bboxes[:, 0]
+        bboxes[:, 3] += bboxes[:, 1]
+        # 类别ID, coco类别id不超过90, 直接用int8
+        labels = np.fromiter((a['category_id'] for a in anns), dtype=np.int8, count=len(anns))
+        # 实例分割
+        masks = [self.coco.annToMask(a) for a in anns] if self.include_mask else []
+        # 处理成[N, K, [x,y,v]] 其中v=0表示没有此点,v=1表示被挡不可见,v=2表示可见, 坐标会超过int8所以用int16
+        keypoints = [a['keypoints'] for a in anns if a.get('keypoints')] if self.include_keypoint else []
+        if keypoints:
+            keypoints = np.asarray(keypoints, dtype=np.int16).reshape(len(keypoints), -1, 3)
+        else:
+            keypoints = np.zeros((0, self.num_keypoints, 3), dtype=np.int16)
+
+        # 输出包含5个东西, 不需要则为空, 读图失败时img为None
         outputs = {
-            "img":[],
+            "img":None,
             "labels":[],
             "bboxes":[],
             "masks":[],
@@ -199,35 +454,68 @@ class CoCoDataGenrator:
         # 处理最终数据 mask
         if self.include_mask:
             # [N, h, w]
-            masks, bboxes = self._resize_mask(origin_masks=masks)
+            masks, mask_bboxes = self._resize_mask(origin_masks=masks)
             outputs['masks'] = masks
-            outputs['bboxes'] = bboxes
+            outputs['bboxes'] = mask_bboxes
 
         # 处理最终数据 keypoint
         if self.include_keypoint:
-            keypoints = np.array(keypoints, dtype=np.int8)
             outputs['keypoints'] = keypoints
 
-        img = io.imread(self.coco.imgs[image_id]['coco_url'])
+        img = self._read_image(image_id)
         if len(np.shape(img)) < 2:
             return outputs
-        elif len(np.shape(img)) == 2:
-            img = np.expand_dims(img, axis=-1)
-            img = np.pad(img, [(0,0), (0,0), (0,2)])
 
-        labels = np.array(labels, dtype=np.int8)
-        bboxes = np.array(bboxes, dtype=np.int16)
-        img_resize, bboxes_resize = self._resize_im(origin_im=img, bboxes=bboxes)
+        img_resize, bboxes_resize = self._resize_im(origin_im=img, bboxes=bboxes, out=im_out)
         outputs['img'] = img_resize
         outputs['labels'] = labels
-        outputs['bboxes'] = bboxes_resize
+        # mask的边框已经是resize后的坐标, 不能再缩放一次
+        outputs['bboxes'] = mask_bboxes if self.include_mask else bboxes_resize
 
         return outputs
 
 
+def pack_coco_images(coco_annotation_file, coco_image_dir, image_pack_file):
+    """ 把标注文件里所有图片的jpeg原始字节拼成一个文件, 给CoCoDataGenrator(image_pack_file=)用,
+        索引{image_id: (offset, length)}和对应的标注文件/图片id一起存在image_pack_file + '.idx'
+    :param coco_annotation_file:
+    :param coco_image_dir:
+    :param image_pack_file:
+    :return:
+    """
+    if not coco_image_dir or not os.path.isdir(coco_image_dir):
+        raise ValueError("coco_image_dir {} is not a directory".format(coco_image_dir))
+
+    coco = CoCoDataGenrator._load_coco(coco_annotation_file)
+    index = {}
+    offset = 0
+    # 先写临时文件再改名, 避免中途退出留下不完整的打包
+    with open(image_pack_file + '.tmp', 'wb') as f:
+        for image_id, img_info in coco.imgs.items():
+            path = os.path.join(coco_image_dir, img_info['file_name'])
+            if not os.path.exists(path):
+                continue
+            with open(path, 'rb') as img_f:
+                data = img_f.read()
+            f.write(data)
+            index[image_id] = (offset, len(data))
+            offset += len(data)
+
+    pack_info = {
+        'annotation_file': coco_annotation_file,
+        'image_ids': set(coco.imgs),
+        'index': index
+    }
+    # 索引也先写临时文件, 打包文件替换好之后再替换索引
+    with open(image_pack_file + '.idx.tmp', 'wb') as f:
+        pickle.dump(pack_info, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(image_pack_file + '.tmp', image_pack_file)
+    os.replace(image_pack_file + '.idx.tmp', image_pack_file + '.idx')
+
+
 if __name__ == "__main__":
     file = "./instances_val2017.json"
-    coco = CoCoDataGenrator(coco_annotation_file=file,include_mask=True,include_keypoint=True)
+    coco = CoCoDataGenrator(coco_annotation_file=file, coco_image_dir="./val2017", include_mask=True, include_keypoint=True)
     # data = coco.next_batch()
     # print(data)
     # data = coco.next_batch()
@@ -21,9 +21,11 @@ def generate_yolo_coco_tfrecord(is_training=True, tfrec_path='./coco2017/', imag
 
     if is_training:
         coco_file = "./coco2017/annotations/instances_val2017.json"
+        coco_image_dir = "./coco2017/val2017"
 
     coco = CoCoDataGenrator(
         coco_annotation_file=coco_file,
+        coco_image_dir=coco_image_dir,
         img_shape=image_shape,
         batch_size=1,
         max_instances=max_instances,
@@ -69,6 +71,7 @@ def generate_yolo_coco_tfrecord(is_training=True, tfrec_path='./coco2017/', imag
         example = tf.train.Example(features=tf.train.Features(feature=feature))
         tfrec_writer.write(example.SerializeToString())
     tfrec_writer.close()
+    coco.close()
 
 
 def parse_single_example(single_record):
@@ -24,6 +24,7 @@ def save_coco_all_wh(anno_file, image_shape, output_anchor_file):
         all_wh.extend(wh)
     all_wh = np.array(all_wh, dtype=np.int16)
     np.savetxt(output_anchor_file, X=all_wh, fmt="%d", delimiter=",", newline="\n")
+    coco.close()
 
 
 def get_wh(wh_file):
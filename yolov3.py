@@ -299,12 +299,11 @@ class YoloV3:
             im_size_max = np.max(im_shapes[i][0:2])
             im_scale = float(self.image_shape[0]) / float(im_size_max)
 
-            # resize原始图片
-            im_resize = cv2.resize(im, None, None, fx=im_scale, fy=im_scale, interpolation=cv2.INTER_LINEAR) / 255.
+            # resize原始图片, 归一化直接写入模型输入, 不产生中间float64数组和额外拷贝
+            im_resize = cv2.resize(im, None, None, fx=im_scale, fy=im_scale, interpolation=cv2.INTER_LINEAR)
             im_resize_shape = np.shape(im_resize)
-            im_blob = np.zeros(self.image_shape, dtype=np.float32)
-            im_blob[0:im_resize_shape[0], 0:im_resize_shape[1], :] = im_resize
-            inputs = np.array([im_blob],dtype=np.float32)
+            inputs = np.zeros((1,) + tuple(self.image_shape), dtype=np.float32)
+            np.multiply(im_resize, 1. / 255, out=inputs[0, 0:im_resize_shape[0], 0:im_resize_shape[1], :])
             nms_bboxes, nms_scores, nms_classes, valid_detection_nums = self.yolo_model.predict(inputs)
 
             batch_bboxes.append(nms_bboxes[0] * self.image_shape[0] / im_scale)
@@ -319,6 +318,7 @@ class YoloV3:
         optimizer = tf.keras.optimizers.Adam(learning_rate=0.001)
         train_data = CoCoDataGenrator(
             coco_annotation_file="./data/instances_val2017.json",
+            coco_image_dir="./data/val2017",
             img_shape=self.image_shape,
             batch_size=self.batch_size,
             max_instances=100
@@ -332,7 +332,7 @@ class YoloV3:
             for batch in range(train_data.total_batch_size):
                 with tf.GradientTape() as tape:
                     data = train_data.next_batch()
-                    gt_imgs = data['imgs'] / 255.
+                    gt_imgs = train_data.as_model_input(data['imgs'])
                     gt_boxes = data['bboxes'] / self.image_shape[0]
                     gt_classes = data['labels']
 
@@ -393,7 +393,7 @@ class YoloV3:
 
                     # image, 只拿每个batch的第一张
                     # gt
-                    gt_img = gt_imgs[0].copy() * 255
+                    gt_img = np.array(data['imgs'][0], dtype=np.float64)
                     gt_boxes = gt_boxes[0] * self.image_shape[0]
                     gt_classes = gt_classes[0]
                     non_zero_ids = np.where(np.sum(gt_boxes, axis=-1))[0]
@@ -405,7 +405,7 @@ class YoloV3:
                                                    int(ymax))
 
                     # pred
-                    pred_img = gt_imgs[0].copy() * 255
+                    pred_img = np.array(data['imgs'][0], dtype=np.float64)
                     boxes, scores, classes, valid_detection_nums = self.yolo_nms(yolo_preds, self.num_class)
                     # print(scores)
                     # print(gt_classes)